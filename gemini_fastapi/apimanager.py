@@ -2,91 +2,97 @@
 
 import os
 import asyncio
-from datetime import datetime
-import time
-from typing import Optional, Dict
+from types import MappingProxyType
+from typing import Optional, Dict, Mapping, Tuple
 
 class APIKeyManager:
     def __init__(self):
         self._api_keys = self._load_api_keys()
-        self._key_status: Dict[str, Dict] = {}  # Stores key usage status
-        self._lock = asyncio.Lock()
+        self._n_keys = len(self._api_keys)
+        self._key_status: Dict[str, Dict] = {  # Stores key usage status
+            key: {'in_use': False, 'last_used': None} for key in self._api_keys
+        }
+        self._released = asyncio.Event()  # Set when a key is released, wakes waiters to rescan
+        self._rr_index = 0  # Round-robin start position for the next key scan
         self.USAGE_TIMEOUT = 30  # seconds
-        self.MAX_RETRIES = 3  # Maximum retries for obtaining a key
-        self.RETRY_DELAY = 2  # Seconds between retries
 
-    def _load_api_keys(self) -> list:
+    def _load_api_keys(self) -> Tuple[str, ...]:
         """Load API keys from environment variables"""
-        api_keys = []
-        for i in range(0, 9):  # Support up to 9 API keys
-            key = os.getenv(f"GOOGLE_API_KEY_{i}")
-            if key:
-                api_keys.append(key)
-
-        return api_keys
+        # Support up to 32 API keys; gaps in the numbering are skipped
+        return tuple(
+            key for i in range(32) if (key := os.getenv(f"GOOGLE_API_KEY_{i}"))
+        )
 
-    async def _is_key_available(self, api_key: str) -> bool:
+    def _is_key_available(self, api_key: str, now: float) -> bool:
         """Check if an API key is available for use"""
-        if api_key not in self._key_status:
+        status = self._key_status[api_key]
+        if not status['in_use']:
             return True
-        
-        last_used = self._key_status[api_key]['last_used']
-        if (datetime.now() - last_used).total_seconds() > self.USAGE_TIMEOUT:
+
+        if now - status['last_used'] > self.USAGE_TIMEOUT:
             return True
         
         return False
 
-    async def _get_key_by_second_digit(self, second_digit: int) -> Optional[str]:
-        """Choose an API key based on the second digit of the current seconds"""
-        index = second_digit % len(self._api_keys)  # To avoid index out of range
-        selected_key = self._api_keys[index]
-        if self._is_key_available(selected_key):
-            return selected_key
-        return None
+    def _seconds_until_next_free(self, now: float) -> float:
+        """Seconds until the oldest in-use key passes USAGE_TIMEOUT"""
+        oldest = min(
+            status['last_used'] for status in self._key_status.values() if status['in_use']
+        )
+        return max(0.0, oldest + self.USAGE_TIMEOUT - now)
 
     async def get_available_key(self) -> Optional[str]:
-        """Get an available key, retrying if needed"""
+        """Get an available key, waiting until one is released or times out"""
         if not self._api_keys:
             return None
 
-        retries = 0
-        while retries < self.MAX_RETRIES:
-            current_time = datetime.now()
-            second_digit = current_time.second % 10  # Get the last digit of seconds
-            key = await self._get_key_by_second_digit(second_digit)
+        n = self._n_keys
+        loop = asyncio.get_running_loop()
+        # No lock needed: nothing between the scan and marking the key awaits,
+        # so the event loop never interleaves two acquisitions
+        while True:
+            # Read the clock once per scan rather than once per key
+            now = loop.time()
 
-            if key:
-                # Mark the key as used
-                async with self._lock:
-                    self._key_status[key] = {'last_used': datetime.now(), 'in_use': True}
-                return key
-            retries += 1
-            await asyncio.sleep(self.RETRY_DELAY)
+            # Scan every key once, starting after the last one handed out
+            for offset in range(n):
+                i = (self._rr_index + offset) % n
+                key = self._api_keys[i]
+                if self._is_key_available(key, now):
+                    # Mark the key as used
+                    self._rr_index = (i + 1) % n
+                    status = self._key_status[key]
+                    status['last_used'] = now
+                    status['in_use'] = True
+                    return key
 
-        return None
+            # Sleep until a key is released or the oldest one times out
+            self._released.clear()
+            try:
+                await asyncio.wait_for(
+                    self._released.wait(), timeout=self._seconds_until_next_free(now)
+                )
+            except asyncio.TimeoutError:
+                pass
 
-    async def release_key(self, api_key: str):
-        """Mark an API key as no longer in use"""
-        async with self._lock:
-            if api_key in self._key_status:
-                self._key_status[api_key]['in_use'] = False
+    async def release_key(self, api_key: str, acquired_at: Optional[float] = None):
+        """
+        Mark an API key as no longer in use. If acquired_at is given, only release
+        it if the key hasn't been handed out again (after USAGE_TIMEOUT) since then
+        """
+        status = self._key_status[api_key]
+        if acquired_at is not None and status['last_used'] != acquired_at:
+            return
+        status['in_use'] = False
+        self._released.set()
 
     async def wait_for_available_key(self, timeout: int = 60) -> Optional[str]:
         """Wait for an available API key with timeout"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            key = await self.get_available_key()
-            if key:
-                return key
-            await asyncio.sleep(1)
-        return None
+        try:
+            return await asyncio.wait_for(self.get_available_key(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
 
-    def get_key_status(self) -> Dict:
-        """Get current status of all API keys"""
-        return {
-            key: {
-                'in_use': self._key_status.get(key, {}).get('in_use', False),
-                'last_used': self._key_status.get(key, {}).get('last_used', None)
-            }
-            for key in self._api_keys
-        }
+    def get_key_status(self) -> Mapping[str, Dict]:
+        """Get a read-only view of the current status of all API keys"""
+        return MappingProxyType(self._key_status)
@@ -1,11 +1,12 @@
 #app.py
 
 import os
+import json
 import asyncio
 import logging
 import time
-import math
-import redis
+import redis.asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import Optional
 from mutagen.mp3 import MP3
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
@@ -16,12 +17,96 @@ import aiofiles
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from celery.result import AsyncResult
-from gemini_fastapi.tasks import process_audio_file, celery_app
+from celery.utils import uuid
+from redis.exceptions import RedisError
+from gemini_fastapi.tasks import (
+    process_audio_file, celery_app, KEY_RELEASE_CHANNEL, TranscriptionFailed
+)
 
 # Import the API manager
 from gemini_fastapi.apimanager import APIKeyManager
 
-app = FastAPI()
+def _prune_task_keys(task_keys: dict, now: float, max_age: float):
+    """
+    Forget tasks whose key has already passed USAGE_TIMEOUT; releasing it would
+    change nothing, and a release that never arrives would otherwise leak the entry
+    """
+    # Entries are added in acquisition order, so the stale ones are at the front
+    for task_id, (_, acquired_at) in list(task_keys.items()):
+        if now - acquired_at <= max_age:
+            break
+        del task_keys[task_id]
+
+async def _release_listener(
+    redis_client: redis.asyncio.Redis,
+    api_manager: APIKeyManager,
+    task_keys: dict
+):
+    """
+    Release API keys as soon as a worker reports that their task has finished.
+    Every web process gets every message, so only keys handed out by this
+    process (tracked in task_keys by task ID) are released here
+    """
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(KEY_RELEASE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    try:
+                        task_id = json.loads(message['data'])['task_id']
+                    except (ValueError, TypeError, KeyError):
+                        task_id = None
+                    if not isinstance(task_id, str):
+                        logger.warning(f"Ignoring malformed key release message: {message['data']!r}")
+                        continue
+                    entry = task_keys.pop(task_id, None)
+                    if entry is None:
+                        # Task was submitted by another web process, or already expired
+                        continue
+                    api_key, acquired_at = entry
+                    try:
+                        # No-op if the key has since been handed to another task
+                        await api_manager.release_key(api_key, acquired_at)
+                    except KeyError:
+                        # Key not loaded by this process
+                        pass
+        except RedisError as e:
+            # Keys still free up after USAGE_TIMEOUT while we reconnect
+            logger.warning(f"API key release listener lost Redis connection: {e}")
+            await asyncio.sleep(5)
+        except Exception as e:
+            # Never let one bad message end releases for the life of the process
+            logger.error(f"API key release listener failed, restarting: {e}", exc_info=True)
+            await asyncio.sleep(5)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create long-lived resources once at startup and close them on shutdown
+    """
+    # API key manager and Redis client are shared by all requests via app.state
+    app.state.api_manager = APIKeyManager()
+    # Task ID -> (API key, acquired_at) for tasks submitted by this process,
+    # awaiting release
+    app.state.task_keys = {}
+    app.state.redis = redis.asyncio.Redis.from_url(
+        os.getenv('REDIS_URL', 'redis://redis:6379/0'),
+        decode_responses=True
+    )
+    release_listener = asyncio.create_task(
+        _release_listener(app.state.redis, app.state.api_manager, app.state.task_keys)
+    )
+    try:
+        yield
+    finally:
+        release_listener.cancel()
+        with suppress(asyncio.CancelledError):
+            await release_listener
+        await app.state.redis.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
@@ -34,13 +119,13 @@ app.mount("/static", StaticFiles(directory="gemini_fastapi/static"), name="stati
 # Load environment variables
 load_dotenv()
 
-# Initialize API Key Manager
-api_manager = APIKeyManager()
-
 # Ensure uploads directory exists
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Read uploads in 1 MiB chunks so memory use doesn't grow with file size
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg'}
 
@@ -60,18 +145,42 @@ class TaskStatusResponse(BaseModel):
     error: Optional[str] = None
 
 def calculate_estimated_processing_time(audio_length: float) -> int:
-    """Calculate estimated processing time based on 3.5 seconds per minute of audio"""
-    return math.ceil(audio_length / 60 * 6)
+    """Calculate estimated processing time based on 6 seconds per minute of audio"""
+    return (int(audio_length) + 9) // 10
 
-def allowed_file(filename: str) -> bool:
-    """Check if file extension is allowed."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def _validate_and_name(filename: str) -> tuple[str, str]:
+    """
+    Check the file extension and generate a unique filename for concurrent uploads.
+    Returns (extension, unique_filename)
+    """
+    base_name, extension = os.path.splitext(filename)
+    ext_low = extension[1:].lower()
+    if ext_low not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid file type. Only MP3, WAV, and OGG files are allowed."
+        )
+    return ext_low, f"{base_name.replace(' ', '_')}_{time.monotonic_ns()}{extension}"
 
-def get_unique_filename(original_filename: str) -> str:
-    """Generate a unique filename to prevent conflicts in concurrent uploads"""
-    timestamp = int(time.time() * 1000)
-    base_name, extension = os.path.splitext(original_filename)
-    return f"{base_name}_{timestamp}{extension}"
+async def _save_upload(file: UploadFile) -> str:
+    """
+    Validate an uploaded file and stream it into UPLOAD_FOLDER.
+    Returns the saved media_path
+    """
+    _, unique_filename = _validate_and_name(file.filename)
+    media_path = os.path.join(UPLOAD_FOLDER, unique_filename)
+
+    try:
+        async with aiofiles.open(media_path, 'wb') as out_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await out_file.write(chunk)
+    except Exception:
+        # Don't leave a partial file behind
+        with suppress(FileNotFoundError):
+            await asyncio.to_thread(os.remove, media_path)
+        raise
+
+    return media_path
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
@@ -88,28 +197,18 @@ async def upload_file(
     if not file.filename:
         raise HTTPException(status_code=400, detail="No selected file")
 
-    if not allowed_file(file.filename):
-        raise HTTPException(status_code=400, detail="File type not allowed")
+    # Asynchronously save the file
+    media_path = await _save_upload(file)
 
     try:
-        # Generate unique filename for concurrent uploads
-        unique_filename = get_unique_filename(file.filename.replace(" ", "_"))
-        media_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-
-        # Asynchronously save the file
-        async with aiofiles.open(media_path, 'wb') as out_file:
-            content = await file.read()
-            await out_file.write(content)
-
         # Get audio file details and validate
         try:
-            audio = MP3(media_path)
+            audio = await asyncio.to_thread(MP3, media_path)
             audio_length = audio.info.length
             if audio_length <= 0:
-                os.remove(media_path)
                 raise ValueError("Invalid audio duration")
         except Exception as e:
-            os.remove(media_path)
+            await asyncio.to_thread(os.remove, media_path)
             raise HTTPException(
                 status_code=400,
                 detail=f"Invalid audio file: {str(e)}"
@@ -127,35 +226,39 @@ async def upload_file(
             'message': 'File uploaded successfully'
         }
 
+    except HTTPException:
+        # Already handled above, including removing the file
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
-        if os.path.exists(media_path):
-            os.remove(media_path)
+        with suppress(FileNotFoundError):
+            await asyncio.to_thread(os.remove, media_path)
         raise HTTPException(status_code=500, detail=str(e))
 
+def _sync_verify(file_path: str) -> tuple[bool, Optional[str]]:
+    """Blocking checks for verify_file_access, run together in one worker thread"""
+    try:
+        # One stat call covers existence and size
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return False, f"File not found: {file_path}"
+    except PermissionError:
+        return False, f"File is not readable: {file_path}"
+    except Exception as e:
+        return False, f"File access error: {str(e)}"
+
+    # Additional check for file size (optional)
+    if st.st_size == 0:
+        return False, f"File is empty: {file_path}"
+
+    return True, ""
+
 async def verify_file_access(file_path: str) -> tuple[bool, Optional[str]]:
     """
     Verify that a file exists and is accessible.
     Returns (success, error_message)
     """
-    try:
-        # Check if file exists
-        if not os.path.exists(file_path):
-            return False, f"File not found: {file_path}"
-        
-        # Check if file is readable
-        if not os.access(file_path, os.R_OK):
-            return False, f"File is not readable: {file_path}"
-        
-        # Additional check for file size (optional)
-        file_size = os.path.getsize(file_path)
-        if file_size == 0:
-            return False, f"File is empty: {file_path}"
-        
-        return True, ""
-    
-    except Exception as e:
-        return False, f"File access error: {str(e)}"
+    return await asyncio.to_thread(_sync_verify, file_path)
 
 @app.post("/process_audio", response_model=AudioProcessResponse)
 async def process_audio(
@@ -166,8 +269,10 @@ async def process_audio(
     """
     Process audio file asynchronously using Celery
     """
+    api_manager = request.app.state.api_manager
+    task_keys = request.app.state.task_keys
     try:
-        logger.info("entered process_audio")
+        logger.debug("entered process_audio")
         # Check if a file is uploaded
         if not file or not file.filename:
             raise HTTPException(
@@ -175,63 +280,57 @@ async def process_audio(
                 detail="No audio file uploaded"
             )
 
-        # Validate file type
-        if not allowed_file(file.filename):
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid file type. Only MP3, WAV, and M4A files are allowed."
-            )
-        logger.info("file type validated")
-        # Generate unique filename
-        unique_filename = get_unique_filename(file.filename)
-        media_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-
-        # Save the uploaded file
-        with open(media_path, "wb") as buffer:
-            buffer.write(await file.read())
-        logger.info("saved file" )
+        # Validate and save the uploaded file
+        media_path = await _save_upload(file)
+        logger.debug("saved file")
         # Verify file access
         file_access_result, error_msg = await verify_file_access(media_path)
         if not file_access_result:
-            os.remove(media_path)  # Clean up the file
+            await asyncio.to_thread(os.remove, media_path)  # Clean up the file
             raise HTTPException(
                 status_code=500,
                 detail=f"File access error: {error_msg}"
             )
 
         # Get API key
-        api_key = await api_manager.get_available_key()
+        api_key = await api_manager.wait_for_available_key()
         if not api_key:
             raise HTTPException(
                 status_code=503,
                 detail="No API key available. Please try again later."
             )
-        logger.info("api_key: " + api_key)
+        logger.debug("api_key: %.10s...", api_key)
         # Validate API key
         if api_key == 'YOUR_API_KEY' or not api_key:
             raise HTTPException(
                 status_code=400,
                 detail="Invalid API key. Please configure a valid Google Generative AI API key."
             )
-        logger.info("validated api_key")
-        logger.info(f"Submitting task with media_path={media_path}, api_key={api_key[:10]}..., context={context}")
+        # Acquisition stamp, so a late release can't free the key from a newer holder
+        acquired_at = api_manager.get_key_status()[api_key]['last_used']
+        logger.debug("validated api_key")
+        logger.info(
+            "Submitting task with media_path=%s, api_key=%.10s..., context=%s",
+            media_path, api_key, context
+        )
 
-        task = process_audio_file.delay(media_path, api_key, context)
+        # Record the key under the task ID before submitting, so a release
+        # published by a fast-finishing task can't arrive before the mapping
+        task_id = uuid()
+        _prune_task_keys(task_keys, asyncio.get_running_loop().time(), api_manager.USAGE_TIMEOUT)
+        task_keys[task_id] = (api_key, acquired_at)
+        task = process_audio_file.apply_async(
+            (media_path, api_key, context), task_id=task_id
+        )
 
         # Log task details
-        logger.info(f"Task submitted: ID = {task.id}")
+        logger.info("Task submitted: ID = %s", task.id)
 
-        # Connect to Redis
-        redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://redis:6379/0'))
-
-        # Check the queue contents (default queue name is 'celery')
-        queue_name = 'celery'
-        queue_contents = redis_client.lrange(queue_name, 0, -1)
-
-        # Log the queue contents
-        logger.info(f"Current Redis Queue Contents ({queue_name}):")
-        for idx, task_data in enumerate(queue_contents):
-            logger.info(f"{idx + 1}: {task_data}")
+        # Log the queue depth (default queue name is 'celery')
+        if logger.isEnabledFor(logging.DEBUG):
+            queue_name = 'celery'
+            queue_length = await request.app.state.redis.llen(queue_name)
+            logger.debug("Current Redis Queue Length (%s): %s", queue_name, queue_length)
 
         return AudioProcessResponse(
             task_id=task.id,
@@ -240,8 +339,10 @@ async def process_audio(
         )
     except Exception as e:
         logger.error(f"Error submitting task: {e}")
+        if 'task_id' in locals():
+            task_keys.pop(task_id, None)
         if 'api_key' in locals() and api_key:
-            await api_manager.release_key(api_key)
+            await api_manager.release_key(api_key, locals().get('acquired_at'))
         raise
 
 @app.get("/task_status/{task_id}", response_model=TaskStatusResponse)
@@ -253,7 +354,10 @@ async def get_task_status(task_id: str):
         task_result = AsyncResult(task_id, app=celery_app)
         
         if task_result.ready():
-            result = task_result.get()
+            result = task_result.get(propagate=False)
+            if isinstance(result, TranscriptionFailed):
+                # Failed tasks carry their error result as the exception argument
+                result = result.args[0]
             
             if task_result.successful():
                 return TaskStatusResponse(
@@ -270,6 +374,7 @@ async def get_task_status(task_id: str):
                 return TaskStatusResponse(
                     status='failed',
                     error=result.get('error', 'Task failed without specific error')
+                    if isinstance(result, dict) else str(result)
                 )
         
         # Handle in-progress tasks
@@ -285,6 +390,15 @@ async def get_task_status(task_id: str):
             error=f"Error checking task status: {str(e)}"
         )
 
+async def _wait_for_result(task_result: AsyncResult, poll_interval: float = 1.0):
+    """
+    Wait for a task to finish without tying up a worker thread while waiting.
+    Each ready() check is a short backend lookup; the wait itself is a sleep
+    """
+    while not await asyncio.to_thread(task_result.ready):
+        await asyncio.sleep(poll_interval)
+    return await asyncio.to_thread(task_result.get)
+
 @app.get("/results", response_class=HTMLResponse)
 async def results(request: Request):
     return templates.TemplateResponse("results.html", {"request": request})
@@ -298,10 +412,17 @@ async def get_results(request: Request, task_id: str):
         # Get the AsyncResult for the task
         task_result = AsyncResult(task_id, app=celery_app)
         
-        # Wait for the task to complete with a longer timeout (e.g., 5 minutes)
+        # Wait for the task to complete with a longer timeout (e.g., 5 minutes).
+        # Poll instead of a blocking get() so an abandoned wait holds no thread.
         try:
-            result = task_result.get(timeout=600)  # 5 minutes timeout
-        except TimeoutError:
+            result = await asyncio.wait_for(
+                _wait_for_result(task_result),
+                timeout=600
+            )
+        except TranscriptionFailed as e:
+            # Failed tasks carry their error result as the exception argument
+            result = e.args[0]
+        except asyncio.TimeoutError:
             logger.error(f"Task {task_id} timed out after 5 minutes")
             return templates.TemplateResponse("results.html", {
                 "request": request, 
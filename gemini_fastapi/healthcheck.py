@@ -4,21 +4,24 @@ Health check script for the Audio Analysis Service
 Run this to verify all services are running correctly
 """
 
-import requests
+import asyncio
+import httpx
 import sys
+import time
 from typing import Dict
 
-def check_service(url: str, service_name: str) -> Dict:
+async def check_service(client: httpx.AsyncClient, url: str, service_name: str) -> Dict:
     """Check if a service is responding"""
+    start = time.perf_counter()
     try:
-        response = requests.get(url, timeout=10)
+        response = await client.get(url)
         return {
             'name': service_name,
             'url': url,
             'status': '✅ UP' if response.status_code == 200 else f'❌ DOWN ({response.status_code})',
-            'response_time': f"{response.elapsed.total_seconds():.2f}s"
+            'response_time': f"{time.perf_counter() - start:.2f}s"
         }
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return {
             'name': service_name,
             'url': url,
@@ -26,7 +29,7 @@ def check_service(url: str, service_name: str) -> Dict:
             'error': str(e)
         }
 
-def main():
+async def main():
     """Main health check function"""
     print("🔍 Audio Analysis Service Health Check")
     print("=" * 50)
@@ -43,12 +46,16 @@ def main():
         }
     ]
 
-    results = []
-    for service in services:
-        print(f"Checking {service['name']}...")
-        result = check_service(service['url'], service['name'])
-        results.append(result)
+    # Probe all services concurrently, then report in order
+    print(f"Checking {len(services)} services...")
+    print()
+    async with httpx.AsyncClient(timeout=10) as client:
+        results = await asyncio.gather(
+            *(check_service(client, s['url'], s['name']) for s in services)
+        )
 
+    for result in results:
+        print(f"{result['name']}:")
         status = result['status']
         if 'error' in result:
             status += f" - {result['error']}"
@@ -71,4 +78,4 @@ def main():
         return 1
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(asyncio.run(main()))
@@ -3,28 +3,36 @@ import time
 import signal
 import subprocess
 import uuid
+import itertools
 from celery import Celery
 from redis import Redis
 from redis.exceptions import RedisError
 import logging
+import logging.handlers
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Sequence, Tuple
 import atexit
 import threading
-from datetime import datetime, timedelta
 import socket
 
+# Redis set holding the names of the workers a scaler has started; each scaler
+# appends its hostname so scalers on different hosts don't share one set
+ACTIVE_WORKERS_KEY = "scaler:active_workers"
+
 @dataclass
 class ScalingConfig:
     min_workers: int = 3
     max_workers: int = 50
     tasks_per_worker: int = 1
     check_interval: int = 10  # seconds
+    max_idle_interval: int = 60  # longest sleep between checks while idle
     scale_up_threshold: float = 0.8  # Scale up when worker utilization > 80%
     scale_down_threshold: float = 0.3  # Scale down when worker utilization < 30%
     cooldown_period: int = 60  # seconds between scaling operations
     worker_startup_time: int = 30  # seconds to wait for worker to start
     worker_prefix: str = "celery_worker"
+    shutdown_grace_period: int = 300  # seconds to let in-flight tasks finish on shutdown
+    queues: Tuple[str, ...] = ("celery",)  # queues whose combined backlog drives scaling
 
 class CeleryScaler:
     def __init__(self, 
@@ -39,13 +47,28 @@ class CeleryScaler:
         
         # Connect to Redis and Celery
         self.redis_conn = Redis.from_url(redis_url, decode_responses=True)
+        self.pipe = self.redis_conn.pipeline(transaction=False)
         self.celery_app = Celery(celery_app_name, broker=redis_url)
+
+        self.active_workers_key = f"{ACTIVE_WORKERS_KEY}:{socket.gethostname()}"
+        # Workers from a previous run are not ours to count
+        try:
+            self.redis_conn.delete(self.active_workers_key)
+        except RedisError as e:
+            self.logger.error(f"Failed to clear stale active worker set: {e}")
         
         # State tracking
-        self.last_scale_time = datetime.now() - timedelta(seconds=self.config.cooldown_period)
+        # Monotonic timestamp, backdated so the first check is not in cooldown
+        self.last_scale_time = time.monotonic() - self.config.cooldown_period
         self.running = False
-        self.worker_processes = {}  # Dictionary to store processes with their unique IDs
-        self.lock = threading.Lock()
+        # Worker name -> process. Only ever replaced wholesale under self.lock, so
+        # readers can take the current reference and iterate it without locking
+        self.worker_processes = {}
+        # Reentrant so a signal handler that interrupts a writer cannot deadlock
+        self.lock = threading.RLock()
+        self._idle_ticks = 0  # Consecutive checks with nothing to do
+        self._shutting_down = False  # Set by the first termination signal
+        self._skip_drain = False  # Set by a second signal to stop workers without waiting
         
         # Register cleanup handlers
         atexit.register(self.cleanup)
@@ -55,6 +78,9 @@ class CeleryScaler:
     def setup_logging(self):
         """Configure logging with rotation and proper formatting."""
         self.logger = logging.getLogger("celery_scaler")
+        if self.logger.handlers:
+            # Already configured by an earlier instance
+            return
         self.logger.setLevel(logging.INFO)
         
         formatter = logging.Formatter(
@@ -81,100 +107,160 @@ class CeleryScaler:
         hostname = socket.gethostname()
         return f"{self.config.worker_prefix}_{hostname}_{unique_id}"
 
-    def get_queue_length(self, queue_name: str = "celery") -> int:
-        """Get the number of tasks in the specified queue with error handling."""
+    def get_queue_length_and_workers(self, queues: Sequence[str] = ("celery",)) -> Tuple[int, int]:
+        """Get the total length of the queues and active worker count in one Redis round trip."""
         try:
-            return int(self.redis_conn.llen(queue_name))
+            for queue_name in queues:
+                self.pipe.llen(queue_name)
+            self.pipe.scard(self.active_workers_key)
+            *queue_lengths, active_workers = self.pipe.execute()
+            return sum(int(length) for length in queue_lengths), int(active_workers)
         except RedisError as e:
-            self.logger.error(f"Redis error while getting queue length: {e}")
-            return 0
+            self.pipe.reset()
+            self.logger.error(f"Redis error while reading scaling metrics: {e}")
         except Exception as e:
-            self.logger.error(f"Unexpected error while getting queue length: {e}")
-            return 0
+            self.pipe.reset()
+            self.logger.error(f"Unexpected error while reading scaling metrics: {e}")
+        # Fallback to process counting
+        return 0, len(self.worker_processes)
 
-    def get_active_workers(self) -> int:
-        """Get number of currently active Celery workers with improved accuracy."""
+    def register_workers(self, *worker_names: str):
+        """Add started workers to the active worker set."""
         try:
-            # Use celery inspect to get actual running workers
-            i = self.celery_app.control.inspect()
-            active_workers = i.active()
-            if active_workers is None:
-                return len(self.worker_processes)
-            return len(active_workers)
-        except Exception as e:
-            self.logger.error(f"Failed to get active workers count: {e}")
-            # Fallback to process counting
-            return len(self.worker_processes)
+            self.redis_conn.sadd(self.active_workers_key, *worker_names)
+        except RedisError as e:
+            self.logger.error(f"Failed to register workers: {e}")
+
+    def unregister_workers(self, *worker_names: str):
+        """Remove stopped workers from the active worker set."""
+        try:
+            self.redis_conn.srem(self.active_workers_key, *worker_names)
+        except RedisError as e:
+            self.logger.error(f"Failed to unregister workers: {e}")
+
+    def reap_exited_workers(self):
+        """Forget workers whose process has exited on its own."""
+        snapshot = self.worker_processes
+        exited = [name for name, process in snapshot.items()
+                  if process.poll() is not None]
+        if not exited:
+            return
+        with self.lock:
+            new = dict(self.worker_processes)
+            for worker_name in exited:
+                new.pop(worker_name, None)
+            self.worker_processes = new
+        for worker_name in exited:
+            self.logger.warning(f"Worker {worker_name} exited unexpectedly")
+        self.unregister_workers(*exited)
 
     def should_scale(self, desired_workers: int, current_workers: int) -> bool:
         """Determine if scaling should occur based on cooldown and thresholds."""
-        if (datetime.now() - self.last_scale_time).seconds < self.config.cooldown_period:
+        if time.monotonic() - self.last_scale_time < self.config.cooldown_period:
             return False
         
         # Prevent rapid scaling
         worker_difference = abs(desired_workers - current_workers)
         return worker_difference >= max(2, int(current_workers * 0.2))
 
-    def scale_workers(self, queue_length: int):
-        """Scale workers based on queue length with safety checks."""
-        with self.lock:
-            current_workers = self.get_active_workers()
-            desired_workers = max(
-                self.config.min_workers,
-                min(self.config.max_workers,
-                    (queue_length // self.config.tasks_per_worker) + 1)
-            )
+    def scale_workers(self, queue_length: int, current_workers: int) -> bool:
+        """Scale workers based on queue length with safety checks. Returns True if scaled."""
+        desired_workers = max(
+            self.config.min_workers,
+            min(self.config.max_workers,
+                (queue_length // self.config.tasks_per_worker) + 1)
+        )
 
-            if not self.should_scale(desired_workers, current_workers):
-                return
+        if not self.should_scale(desired_workers, current_workers):
+            return False
 
-            if current_workers < desired_workers:
-                self.scale_up(desired_workers - current_workers)
-            elif current_workers > desired_workers:
-                self.scale_down(current_workers - desired_workers)
+        if current_workers < desired_workers:
+            self.scale_up(desired_workers - current_workers)
+        elif current_workers > desired_workers:
+            self.scale_down(current_workers - desired_workers)
+        return True
 
     def scale_up(self, count: int):
         """Scale up the number of Celery workers with process tracking."""
         self.logger.info(f"Scaling up by {count} workers")
+        started = []
         try:
             for _ in range(count):
                 worker_name = self.generate_worker_name()
+                # Skip the startup sync and gossip with peer workers; the scaler
+                # tracks its own workers, so these only add startup latency
                 process = subprocess.Popen(
                     ["celery", "-A", self.celery_app.main, "worker",
                      "--loglevel=info", "--concurrency=1",
+                     "--without-mingle", "--without-gossip",
+                     "-Q", ",".join(self.config.queues),
                      "-n", worker_name],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
+                    # Nothing reads these pipes; a full pipe would block the worker
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
                 )
-                self.worker_processes[worker_name] = process
+                with self.lock:
+                    new = dict(self.worker_processes)
+                    new[worker_name] = process
+                    self.worker_processes = new
+                started.append(worker_name)
             
-            self.last_scale_time = datetime.now()
+            self.last_scale_time = time.monotonic()
             # Wait briefly to ensure workers are starting up
             time.sleep(min(2, self.config.worker_startup_time // count))
             
         except Exception as e:
             self.logger.error(f"Failed to scale up workers: {e}")
+        finally:
+            if started:
+                self.register_workers(*started)
+
+    def stop_processes(self, workers, timeout: float = 5):
+        """Terminate workers together, then reap them against one shared deadline."""
+        # Send SIGTERM to every worker first for graceful shutdown
+        pending = []
+        for worker_name, process in workers:
+            try:
+                process.terminate()
+                pending.append((worker_name, process))
+            except Exception as e:
+                self.logger.error(f"Failed to terminate worker {worker_name}: {e}")
+
+        # Wait briefly for all of them at once
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            pending = [(name, p) for name, p in pending if p.poll() is None]
+            if pending:
+                time.sleep(0.05)
+
+        # Force kill any worker that failed to shut down gracefully
+        for worker_name, process in pending:
+            self.logger.warning(f"Worker {worker_name} did not stop in time, killing it")
+            try:
+                process.kill()
+                process.wait(timeout=1)
+            except Exception as e:
+                self.logger.error(f"Failed to kill worker {worker_name}: {e}")
 
     def scale_down(self, count: int):
         """Scale down workers gracefully with process tracking."""
         self.logger.info(f"Scaling down by {count} workers")
         try:
-            workers_to_remove = list(self.worker_processes.items())[:count]
+            # Stop the most recently started workers first, keeping long-running ones warm
+            # Pick and detach the victims in one step so no other caller can
+            # select or terminate the same workers
+            with self.lock:
+                new = dict(self.worker_processes)
+                workers_to_remove = list(itertools.islice(reversed(new.items()), count))
+                for worker_name, _ in workers_to_remove:
+                    del new[worker_name]
+                self.worker_processes = new
+            if workers_to_remove:
+                self.unregister_workers(*(name for name, _ in workers_to_remove))
             
-            for worker_name, process in workers_to_remove:
-                # Send SIGTERM for graceful shutdown
-                process.terminate()
-                
-                # Wait briefly for graceful shutdown
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    # Force kill if graceful shutdown fails
-                    process.kill()
-                
-                del self.worker_processes[worker_name]
+            self.stop_processes(workers_to_remove)
             
-            self.last_scale_time = datetime.now()
+            self.last_scale_time = time.monotonic()
             
         except Exception as e:
             self.logger.error(f"Failed to scale down workers: {e}")
@@ -184,17 +270,89 @@ class CeleryScaler:
         self.logger.info("Cleaning up resources...")
         self.running = False
         
+        # Take ownership of every worker before stopping them, so a second
+        # cleanup (atexit after a signal) finds nothing left to terminate
+        with self.lock:
+            workers, self.worker_processes = self.worker_processes, {}
+
         # Gracefully shutdown all workers
-        for worker_name, process in self.worker_processes.items():
+        self.stop_processes(list(workers.items()))
+
+        try:
+            self.redis_conn.delete(self.active_workers_key)
+        except RedisError as e:
+            self.logger.error(f"Failed to clear active worker set: {e}")
+
+    def drain_workers(self):
+        """Stop workers from taking new tasks and wait for in-flight tasks to finish."""
+        # Workers started with "-n name" register as celery@name
+        destinations = [f"celery@{worker_name}" for worker_name in self.worker_processes]
+        if not destinations:
+            return
+
+        try:
+            for queue_name in self.config.queues:
+                self.celery_app.control.cancel_consumer(queue_name, destination=destinations)
+        except Exception as e:
+            self.logger.error(f"Failed to cancel consumers, skipping drain: {e}")
+            return
+
+        # One inspector reused for every poll, with a short reply timeout
+        inspector = self.celery_app.control.inspect(timeout=0.25)
+        deadline = time.monotonic() + self.config.shutdown_grace_period
+        while time.monotonic() < deadline:
+            if self._skip_drain:
+                self.logger.warning("Drain cut short, stopping workers now")
+                return
+
+            # Only ask workers whose process is still alive
+            snapshot = self.worker_processes
+            inspector.destination = [
+                f"celery@{worker_name}"
+                for worker_name, process in snapshot.items()
+                if process.poll() is None
+            ]
+            if not inspector.destination:
+                self.logger.info("All workers have exited")
+                return
+
             try:
-                process.terminate()
-                process.wait(timeout=5)
-            except Exception:
-                process.kill()
+                active = inspector.active() or {}
+                # Prefetched tasks are not active yet but still run before exit
+                reserved = inspector.reserved() or {}
+            except Exception as e:
+                self.logger.error(f"Failed to inspect active tasks, skipping drain: {e}")
+                return
+
+            # A worker that missed the short timeout may still be busy
+            in_flight = (sum(len(tasks) for tasks in active.values())
+                         + sum(len(tasks) for tasks in reserved.values()))
+            no_reply = len(inspector.destination) - len(active.keys() & reserved.keys())
+            if not in_flight and not no_reply:
+                self.logger.info("All in-flight tasks finished")
+                return
+
+            self.logger.info(
+                f"Waiting for {in_flight} in-flight tasks to finish "
+                f"({no_reply} workers did not reply)"
+            )
+            time.sleep(1)
+
+        self.logger.warning("Shutdown grace period expired with tasks still running")
 
     def handle_sigterm(self, signum, frame):
         """Handle termination signals gracefully."""
         self.logger.info(f"Received signal {signum}")
+        self.running = False
+        if self._shutting_down:
+            # Handlers re-enter during the drain; rather than starting a second
+            # one, make the first stop waiting so it goes straight to cleanup
+            self.logger.warning("Received another signal, skipping the rest of the drain")
+            self._skip_drain = True
+            return
+
+        self._shutting_down = True
+        self.drain_workers()
         self.cleanup()
         exit(0)
 
@@ -202,30 +360,44 @@ class CeleryScaler:
         """Main loop with improved error handling and monitoring."""
         self.logger.info("Starting Celery auto-scaler...")
         self.running = True
+        last_workers = None
         
         while self.running:
             try:
-                queue_length = self.get_queue_length()
-                current_workers = self.get_active_workers()
+                self.reap_exited_workers()
+                queue_length, current_workers = self.get_queue_length_and_workers(self.config.queues)
                 
                 self.logger.info(
                     f"Status - Queue: {queue_length}, Workers: {current_workers}"
                 )
                 
-                self.scale_workers(queue_length)
+                scaled = self.scale_workers(queue_length, current_workers)
                 
-                # Health check
-                if current_workers < self.config.min_workers:
+                # Health check, unless scale_workers already started workers
+                # from this same stale count
+                if not scaled and current_workers < self.config.min_workers:
                     self.logger.warning(
                         f"Worker count ({current_workers}) below minimum "
                         f"threshold ({self.config.min_workers})"
                     )
                     self.scale_up(self.config.min_workers - current_workers)
+                    scaled = True
+
+                # Back off while nothing is happening, snap back on any activity
+                if scaled or queue_length > 0 or current_workers != last_workers:
+                    self._idle_ticks = 0
+                else:
+                    self._idle_ticks += 1
+                last_workers = current_workers
                 
             except Exception as e:
                 self.logger.error(f"Error in main loop: {e}")
+                self._idle_ticks = 0
             
-            time.sleep(self.config.check_interval)
+            time.sleep(min(
+                self.config.check_interval * (2 ** min(self._idle_ticks, 3)),
+                max(self.config.max_idle_interval, self.config.check_interval)
+            ))
 
 if __name__ == "__main__":
     # Example usage with custom configuration
@@ -234,11 +406,14 @@ if __name__ == "__main__":
         max_workers=int(os.getenv('MAX_WORKERS', '50')),
         tasks_per_worker=int(os.getenv('TASKS_PER_WORKER', '1')),
         check_interval=int(os.getenv('CHECK_INTERVAL', '10')),
+        max_idle_interval=int(os.getenv('MAX_IDLE_INTERVAL', '60')),
         scale_up_threshold=float(os.getenv('SCALE_UP_THRESHOLD', '0.8')),
         scale_down_threshold=float(os.getenv('SCALE_DOWN_THRESHOLD', '0.3')),
         cooldown_period=int(os.getenv('COOLDOWN_PERIOD', '60')),
         worker_startup_time=int(os.getenv('WORKER_STARTUP_TIME', '30')),
-        worker_prefix=os.getenv('WORKER_PREFIX', 'celery_worker')
+        worker_prefix=os.getenv('WORKER_PREFIX', 'celery_worker'),
+        shutdown_grace_period=int(os.getenv('SHUTDOWN_GRACE_PERIOD', '300')),
+        queues=tuple(q.strip() for q in os.getenv('SCALER_QUEUES', 'celery').split(',') if q.strip())
     )
     
     scaler = CeleryScaler(
@@ -3,24 +3,90 @@
 from celery import Celery
 import logging
 import asyncio
-import nest_asyncio
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from datetime import datetime
 from gemini_fastapi.transcription import transcribe_audio, cleanup_file, validate_api_key
-from celery.signals import task_success, task_failure
+from celery.signals import task_success, task_failure, task_postrun
+from redis import Redis
+from redis.exceptions import RedisError
 import os
-
-# Apply nest_asyncio to handle event loops in multi-threaded environments
-nest_asyncio.apply()
+import json
 
 # Configure the Celery app
 redis_url = os.getenv('REDIS_URL', 'redis://redis:6379/0')
 celery_app = Celery('my_app', broker=redis_url, backend=redis_url)
 
+# Pub/sub channel used to tell the web processes an API key is free again
+KEY_RELEASE_CHANNEL = 'api_key_release'
+redis_client = Redis.from_url(redis_url)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# One event loop per worker process, reused across tasks
+_LOOP = None
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the worker process's event loop, creating it on first use
+    """
+    global _LOOP
+    if _LOOP is None or _LOOP.is_closed():
+        _LOOP = asyncio.new_event_loop()
+        asyncio.set_event_loop(_LOOP)
+    return _LOOP
+
+def _run_on_loop(coro):
+    """
+    Run a coroutine on the worker's event loop. If the run is interrupted
+    (e.g. SoftTimeLimitExceeded), cancel whatever is left on the loop so it
+    can't resume inside a later, unrelated task
+    """
+    loop = _get_loop()
+    try:
+        return loop.run_until_complete(coro)
+    except BaseException:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        raise
+
+async def _run_and_cleanup(media_path: str, api_key: str, context: str = None):
+    """
+    Transcribe the audio file, then remove it, in a single loop entry
+    """
+    result = await transcribe_audio(
+        media_path=media_path,
+        api_key=api_key,
+        context=context
+    )
+
+    # Cleanup file after processing
+    logger.info(f"Cleaning up file: {media_path}")
+    await cleanup_file(media_path)
+    return result
+
+# Errors worth retrying; anything else fails the task straight away
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    # HTTP 429; ResourceExhausted is the gRPC name and subclasses TooManyRequests
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    ConnectionError,
+    TimeoutError,
+)
+
+class TranscriptionFailed(Exception):
+    """
+    Raised with the task's error result as args[0] so Celery records FAILURE
+    """
+
 def configure_genai(api_key: str):
     """
     Configure Google Generative AI with the provided API key
@@ -36,8 +102,11 @@ def configure_genai(api_key: str):
 @celery_app.task(bind=True, 
                  soft_time_limit=300, 
                  time_limit=600, 
-                 autoretry_for=(Exception,), 
-                 retry_kwargs={'max_retries': 3, 'countdown': 5},
+                 autoretry_for=TRANSIENT_ERRORS,
+                 max_retries=3,
+                 retry_backoff=True,
+                 retry_backoff_max=60,
+                 retry_jitter=True,
                  track_started=True)
 def process_audio_file(self, media_path: str, api_key: str, context: str = None):
     """
@@ -48,29 +117,15 @@ def process_audio_file(self, media_path: str, api_key: str, context: str = None)
         if not media_path or not api_key:
             raise ValueError("media_path and api_key must be provided")
 
-        # Update task state to STARTED
-        self.update_state(state='STARTED', meta={'status': 'Processing audio file'})
-
         # Configure Generative AI
         configure_genai(api_key)
 
         # Log received arguments
         logger.info(f"Received arguments - media_path: {media_path}, api_key: {api_key[:10]}..., context: {context}")
 
-        # Run transcription synchronously
+        # Run transcription and cleanup on the worker's event loop
         logger.info(f"Starting transcription for: {media_path}")
-        
-        # Use asyncio.run to execute the async function
-        result = asyncio.run(transcribe_audio(
-            media_path=media_path,
-            api_key=api_key,
-            context=context,
-            max_retries=3
-        ))
-
-        # Cleanup file after processing
-        logger.info(f"Cleaning up file: {media_path}")
-        asyncio.run(cleanup_file(media_path))
+        result = _run_on_loop(_run_and_cleanup(media_path, api_key, context))
 
         # Ensure consistent result structure
         task_result = {
@@ -82,23 +137,21 @@ def process_audio_file(self, media_path: str, api_key: str, context: str = None)
             'error': result.get('error', None)
         }
 
-        # Update task state with the result
-        self.update_state(
-            state='SUCCESS',
-            meta=task_result
-        )
-
-
-
+        # Celery stores the return value as the SUCCESS result
         return task_result
 
     except Exception as e:
+        if isinstance(e, TRANSIENT_ERRORS) and self.request.retries < self.max_retries:
+            # Keep the file for the retry; Celery reschedules with backoff
+            logger.warning(f"Transient error processing audio file, retrying: {e}")
+            raise
+
         # Log the full exception details
         logger.error(f"Error processing audio file: {e}", exc_info=True)
         
         # Attempt to cleanup file even if processing fails
         try:
-            asyncio.run(cleanup_file(media_path))
+            _run_on_loop(cleanup_file(media_path))
         except Exception as cleanup_error:
             logger.warning(f"File cleanup error: {cleanup_error}")
         
@@ -112,13 +165,8 @@ def process_audio_file(self, media_path: str, api_key: str, context: str = None)
             'error': str(e)
         }
 
-        # Update task state with error
-        self.update_state(
-            state='FAILURE',
-            meta=error_result
-        )
-        
-        return error_result
+        # Celery records FAILURE with the error result as the exception argument
+        raise TranscriptionFailed(error_result) from e
 
 # Task success signal handler
 @task_success.connect
@@ -130,3 +178,17 @@ def handle_task_success(sender=None, result=None, **kwargs):
 def handle_task_failure(sender=None, exception=None, traceback=None, **kwargs):
     logger.error(f"Task {sender} failed with exception: {exception}")
     logger.error(f"Traceback: {traceback}")
+
+# Task postrun signal handler
+@task_postrun.connect(sender=process_audio_file)
+def handle_task_postrun(sender=None, task_id=None, args=None, kwargs=None, state=None, **extra):
+    """Publish the task's ID so the web process that submitted it can release its key"""
+    if state == 'RETRY':
+        # The retried task will use the same key again
+        return
+
+    try:
+        # Only the task ID: any subscriber can read this channel, so never the key
+        redis_client.publish(KEY_RELEASE_CHANNEL, json.dumps({'task_id': task_id}))
+    except RedisError as e:
+        logger.warning(f"Failed to publish API key release for task {task_id}: {e}")
@@ -2,7 +2,7 @@ import os
 import logging
 import google.generativeai as genai
 import asyncio
-import traceback
+import functools
 from typing import Optional, Dict, Any
 from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockThreshold
 
@@ -10,32 +10,67 @@ from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockT
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
-async def validate_api_key(api_key: str) -> bool:
+# Configure safety settings to be less restrictive
+_SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE
+}
+
+_GENERATION_CONFIG = GenerationConfig(
+    temperature=0.7,
+    max_output_tokens=1280000
+)
+
+PROMPT_PATH = "gemini_fastapi/prompt_1.txt"
+
+@functools.lru_cache(maxsize=None)
+def _get_prompt() -> str:
     """
-    Validate the Google Generative AI API key
+    Read the analysis prompt once per worker process
     """
-    if not api_key or api_key == 'YOUR_API_KEY':
-        logger.error("Invalid API key provided")
-        return False
-    
-    try:
-        genai.configure(api_key=api_key)
-        # Try a simple test to verify key works
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        model.generate_content("Test")
+    with open(PROMPT_PATH, "r", encoding="utf-8") as file:
+        return file.read()
+
+@functools.lru_cache(maxsize=32)
+def _get_model(model_name: str, api_key: str) -> genai.GenerativeModel:
+    """
+    Reuse one model per (model, API key).
+    A model binds the client of whichever key was configured when it first
+    generates, so a model cached by name alone would keep using that key.
+    """
+    return genai.GenerativeModel(
+        model_name,
+        generation_config=_GENERATION_CONFIG,
+        safety_settings=_SAFETY_SETTINGS
+    )
+
+# Keys that have already produced a transcription in this process
+_VALIDATED_KEYS: set[str] = set()
+
+def validate_api_key(api_key: str) -> bool:
+    """
+    Sanity-check the Google Generative AI API key locally.
+    A bad key that passes this check still fails on the first real request.
+    """
+    if api_key in _VALIDATED_KEYS:
         return True
-    except Exception as e:
-        logger.error(f"API key validation failed: {e}")
+
+    if not api_key or api_key == 'YOUR_API_KEY' or len(api_key) < 20:
+        logger.error("Invalid API key provided")
         return False
 
+    return True
+
 async def transcribe_audio(
     media_path: str,
     api_key: str,
-    context: Optional[str] = None,
-    max_retries: int = 3
+    context: Optional[str] = None
 ) -> Dict[str, Any]:
     """
-    Transcribe and analyze audio file using Google Generative AI
+    Transcribe and analyze audio file using Google Generative AI.
+    Errors propagate to the caller; the Celery task owns retries.
     """
     # Validate API key first
     if not validate_api_key(api_key):
@@ -46,85 +81,53 @@ async def transcribe_audio(
             'details': 'API key validation failed'
         }
 
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Transcription attempt {attempt + 1}")
-
-            # Validate file existence and readability
-            if not os.path.exists(media_path):
-                raise FileNotFoundError(f"Audio file not found: {media_path}")
-            
-            if os.path.getsize(media_path) == 0:
-                raise ValueError(f"Audio file is empty: {media_path}")
-
-            # Upload the audio file using the new files API
-            audio_file = genai.upload_file(media_path)
-            logger.info(f"File uploaded successfully: {audio_file}")
-
-            # Configure safety settings to be less restrictive
-            safety_settings = {
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE
-            }
-
-            # Use the Gemini 1.5 Flash model which supports multimodal input
-            model = genai.GenerativeModel(
-                'gemini-2.0-flash',
-                generation_config=GenerationConfig(
-                    temperature=0.7,
-                    max_output_tokens=1280000
-                ),
-                safety_settings=safety_settings
-            )
-
-            # Read the prompt from file
-            with open("gemini_fastapi/prompt_1.txt", "r", encoding="utf-8") as file:
-                prompt_1_content = file.read()
-
-            # Prepare the prompt
-            prompt = f"""
-            Context: {context or 'General conversation analysis'}
-
-            {prompt_1_content}
-            """
-
-            # Generate content with the audio file using the new API
-            response = model.generate_content([audio_file, prompt])
-
-            # Process the response
-            if response and response.text:
-                return {
-                    'success': True,
-                    'transcription': response.text,
-                    'context': context or 'General conversation',
-                    'details': 'Transcription completed successfully'
-                }
-            else:
-                logger.error("No transcription generated")
-                raise ValueError("Failed to generate transcription")
-
-        except Exception as e:
-            logger.error(f"Audio transcription error on attempt {attempt + 1}: {e}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            
-            if attempt == max_retries - 1:
-                return {
-                    'success': False,
-                    'error': str(e),
-                    'context': context,
-                    'details': traceback.format_exc()
-                }
-
-            # Wait before retrying
-            await asyncio.sleep(2 ** attempt)
+    loop = asyncio.get_running_loop()
+    logger.info(f"Starting transcription of {media_path}")
+
+    # Validate file existence and size with a single stat call
+    try:
+        st = os.stat(media_path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Audio file not found: {media_path}")
+
+    if st.st_size == 0:
+        raise ValueError(f"Audio file is empty: {media_path}")
+
+    # Use the Gemini 2.0 Flash model which supports multimodal input
+    model = _get_model('gemini-2.0-flash', api_key)
+
+    # Read the prompt from file (cached after the first task)
+    prompt_1_content = _get_prompt()
+
+    # Prepare the prompt
+    prompt = f"""
+    Context: {context or 'General conversation analysis'}
+
+    {prompt_1_content}
+    """
+
+    # Upload only once the model and prompt are ready (both cached and cheap),
+    # so a failure setting them up can't leave an upload running on a file
+    # the task is about to delete. The client is blocking, so run it in a thread
+    audio_file = await loop.run_in_executor(None, genai.upload_file, media_path)
+    logger.info(f"File uploaded successfully: {audio_file}")
+
+    # Generate content with the audio file using the new API
+    response = await loop.run_in_executor(
+        None, model.generate_content, [audio_file, prompt]
+    )
+
+    # Process the response
+    if not (response and response.text):
+        logger.error("No transcription generated")
+        raise ValueError("Failed to generate transcription")
 
+    _VALIDATED_KEYS.add(api_key)
     return {
-        'success': False,
-        'error': 'Maximum retries exceeded',
-        'context': context,
-        'details': 'Failed to transcribe audio after multiple attempts'
+        'success': True,
+        'transcription': response.text,
+        'context': context or 'General conversation',
+        'details': 'Transcription completed successfully'
     }
 
 async def cleanup_file(media_path: str):
@@ -132,9 +135,11 @@ async def cleanup_file(media_path: str):
     Clean up the media file after processing.
     """
     try:
-        if os.path.exists(media_path):
-            os.remove(media_path)
-            logger.info(f"Successfully removed file: {media_path}")
+        os.remove(media_path)
+        logger.info(f"Successfully removed file: {media_path}")
+    except FileNotFoundError:
+        # Already removed
+        pass
     except Exception as e:
         logger.warning(f"Error during file cleanup: {e}")
         raise